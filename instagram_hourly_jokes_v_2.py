@@ -19,26 +19,22 @@ import time
 import json
 import logging
 import hashlib
+import bisect
+import functools
 import math
 import random
 import subprocess
 import shutil
 import tempfile
 import smtplib
+from collections import deque
 from email.message import EmailMessage
 from datetime import datetime
 
+import numpy as np
 import requests
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 
-try:
-    import moviepy.editor as mpy
-    from moviepy.editor import ImageSequenceClip, AudioFileClip, concatenate_audioclips
-    import numpy as np
-    MOVIEPY_AVAILABLE = True
-except Exception:
-    MOVIEPY_AVAILABLE = False
-
 from instagrapi import Client
 from dotenv import load_dotenv
 
@@ -66,6 +62,7 @@ ALERT_EMAIL_FROM = os.getenv("ALERT_EMAIL_FROM")
 ALERT_EMAIL_TO = os.getenv("ALERT_EMAIL_TO")
 
 SEEN_CACHE_FILE = os.path.join(OUTPUT_DIR, "seen_jokes.json")
+SEEN_MAX = 500
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
@@ -74,10 +71,32 @@ logger = logging.getLogger("insta-hourly-jokes")
 FFMPEG_BIN = shutil.which("ffmpeg") or "/usr/bin/ffmpeg"
 FFPROBE_BIN = shutil.which("ffprobe") or "/usr/bin/ffprobe"
 
+
+def _detect_nvenc():
+    """True when ffmpeg lists h264_nvenc and can actually open it (GPU + driver present)."""
+    if not os.path.exists(FFMPEG_BIN):
+        return False
+    try:
+        p = subprocess.run([FFMPEG_BIN, '-hide_banner', '-encoders'], capture_output=True, timeout=10)
+        if b'h264_nvenc' not in p.stdout:
+            return False
+        # builds often ship the encoder without a usable GPU; a one-frame test encode tells them apart
+        p = subprocess.run([FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=s=256x256',
+                            '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'], capture_output=True, timeout=20)
+        return p.returncode == 0
+    except Exception:
+        return False
+
+
+NVENC_AVAILABLE = _detect_nvenc()
+
+# videos already encoded with the Instagram settings; uploads skip re-transcoding these
+IG_COMPATIBLE_PATHS = set()
+
 # ---- Utility helpers ----
 
 def stable_key(text):
-    return hashlib.sha256((text or "").strip().lower().encode()).hexdigest()
+    return hashlib.blake2b((text or "").strip().lower().encode(), digest_size=16).hexdigest()
 
 
 def load_seen():
@@ -96,7 +115,7 @@ def save_seen(seen):
     try:
         tmp = SEEN_CACHE_FILE + ".tmp"
         with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(seen[-500:], f, ensure_ascii=False, indent=2)
+            json.dump(list(seen)[-SEEN_MAX:], f, ensure_ascii=False, indent=2)
             f.flush(); os.fsync(f.fileno())
         os.replace(tmp, SEEN_CACHE_FILE)
     except Exception as e:
@@ -117,13 +136,35 @@ JOKES = [
 ]
 
 # ---- Rendering helpers ----
+@functools.lru_cache(maxsize=8)
+def _get_bg(size=(IMAGE_WIDTH, IMAGE_HEIGHT)):
+    # concentric 1px ellipse outlines (x radius i, y radius 0.6*i, every 12px),
+    # computed over the whole canvas at once instead of one draw call per ring
+    step = 12
+    width, height = size
+    cx, cy = width // 2, height // 2
+    yy, xx = np.ogrid[:height, :width]
+    r = np.sqrt(((xx - cx) / 1.0) ** 2 + ((yy - cy) / 0.6) ** 2)
+    ring = np.rint(r / step) * step
+    mask = (np.abs(r - ring) <= 0.5) & (ring < max(width, height))
+    red = (6 + (ring / 100) % 200).astype(np.uint8)
+    green = (12 + (ring / 60) % 180).astype(np.uint8)
+    blue = (30 + (ring / 30) % 220).astype(np.uint8)
+    rings = np.dstack((red, green, blue))
+    arr = np.where(mask[..., None], rings, np.array(BACKGROUND_COLOR, dtype=np.uint8))
+    return Image.fromarray(arr.astype(np.uint8), "RGB").filter(ImageFilter.GaussianBlur(24))
+
+
 def futuristic_background():
-    base = Image.new("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT), BACKGROUND_COLOR)
-    draw = ImageDraw.Draw(base)
-    for i in range(0, max(IMAGE_WIDTH, IMAGE_HEIGHT), 12):
-        color = (int(6 + (i/100) % 200), int(12 + (i/60) % 180), int(30 + (i/30) % 220))
-        draw.ellipse([IMAGE_WIDTH//2 - i, IMAGE_HEIGHT//2 - int(i*0.6), IMAGE_WIDTH//2 + i, IMAGE_HEIGHT//2 + int(i*0.6)], outline=color)
-    return base.filter(ImageFilter.GaussianBlur(24))
+    return _get_bg().copy()
+
+
+@functools.lru_cache(maxsize=8)
+def _get_font(size, path=None):
+    try:
+        return ImageFont.truetype(path or FONT_PATH or "DejaVuSansMono.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
 
 
 def _text_bbox_size(draw, text, font):
@@ -137,20 +178,34 @@ def _text_bbox_size(draw, text, font):
             return len(text)*7, FONT_SIZE
 
 
+def _word_measurer(draw, font):
+    """Return a width function for single words; monospace fonts need no PIL call per word."""
+    if not hasattr(font, 'getlength'):
+        return lambda word: _text_bbox_size(draw, word, font)[0]
+    char_w = font.getlength('M')
+    if char_w == font.getlength('i'):
+        return lambda word: len(word) * char_w
+    return font.getlength
+
+
 def wrap_text(draw, text, font, max_w):
     words = text.split()
     if not words:
         return [""]
+    measure = _word_measurer(draw, font)
+    space_w = measure(" ")
     lines = []
     cur = words[0]
+    cur_w = measure(cur)
     for w in words[1:]:
-        test = cur + " " + w
-        tw, _ = _text_bbox_size(draw, test, font)
-        if tw <= max_w:
-            cur = test
+        w_px = measure(w)
+        if cur_w + space_w + w_px <= max_w:
+            cur = cur + " " + w
+            cur_w += space_w + w_px
         else:
             lines.append(cur)
             cur = w
+            cur_w = w_px
     lines.append(cur)
     return lines
 
@@ -158,56 +213,56 @@ def wrap_text(draw, text, font, max_w):
 def render_image(text, out_path):
     img = futuristic_background()
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype(FONT_PATH or "DejaVuSansMono.ttf", FONT_SIZE)
-    except Exception:
-        font = ImageFont.load_default()
+    font = _get_font(FONT_SIZE)
 
     pad_x, pad_y = 80, 120
     inner_w = IMAGE_WIDTH - pad_x*2
     cur_size = getattr(font, 'size', FONT_SIZE)
     while True:
-        try:
-            f = ImageFont.truetype(FONT_PATH or "DejaVuSansMono.ttf", cur_size)
-        except Exception:
-            f = ImageFont.load_default()
+        f = _get_font(cur_size)
         lines = []
         for p in text.split('\n'):
             lines.extend(wrap_text(draw, p.strip(), f, inner_w - 40))
         _, line_h = _text_bbox_size(draw, 'Ay', f)
         if line_h * len(lines) <= (IMAGE_HEIGHT - pad_y*2) or cur_size <= MIN_FONT_SIZE:
-            font = f
+            # keep the wrap that fit; no need to wrap again at this size
+            font, final_lines = f, lines
             break
         cur_size = max(MIN_FONT_SIZE, cur_size - 2)
 
-    lines = []
-    for p in text.split('\n'):
-        lines.extend(wrap_text(draw, p.strip(), font, inner_w - 40))
-
+    lines = final_lines
     y = 140
     for i, line in enumerate(lines):
         draw.text((pad_x, y + i * (getattr(font, 'size', FONT_SIZE) + 6)), "$ " + line, font=font, fill=TEXT_COLOR)
 
-    try:
-        hfont = ImageFont.truetype("DejaVuSans.ttf", 16)
-    except Exception:
-        hfont = ImageFont.load_default()
+    hfont = _get_font(16, "DejaVuSans.ttf")
     draw.text((pad_x, pad_y - 40), "404CodeChugger", font=hfont, fill=(180,200,220))
 
-    img.save(out_path, quality=92)
+    img.save(out_path, quality=92, optimize=True, progressive=True, subsampling=2)
     return out_path
 
 # ---- Video render ----
+def _line_layer(line, font, x, y, prompt_w):
+    """Render one terminal line and return (x0, y0, rgb, alpha) cropped to its ink, or None."""
+    layer = Image.new("RGBA", (IMAGE_WIDTH, IMAGE_HEIGHT), (0, 0, 0, 0))
+    ld = ImageDraw.Draw(layer)
+    ld.text((x, y), "$ ", font=font, fill=(140,150,165))
+    ld.text((x + prompt_w, y), line, font=font, fill=TEXT_COLOR)
+    bbox = layer.getbbox()
+    if bbox is None:
+        return None
+    arr = np.asarray(layer.crop(bbox), dtype=np.float32)
+    return bbox[0], bbox[1], arr[..., :3], arr[..., 3:] / 255.0
+
+
 def render_video(text, out_path_mp4, fps=24, max_duration=12):
-    if not MOVIEPY_AVAILABLE:
-        logger.warning("moviepy missing — falling back to image")
+    if not os.path.exists(FFMPEG_BIN):
+        logger.warning("ffmpeg missing — falling back to image")
         return render_image(text, out_path_mp4.rsplit('.',1)[0] + '.jpg')
 
-    base = futuristic_background()
-    try:
-        font = ImageFont.truetype(FONT_PATH or "DejaVuSansMono.ttf", 36)
-    except Exception:
-        font = ImageFont.load_default()
+    # read-only here: every frame works on its own copy
+    base = _get_bg()
+    font = _get_font(36)
 
     draw_tmp = ImageDraw.Draw(base)
     lines = []
@@ -219,58 +274,78 @@ def render_video(text, out_path_mp4, fps=24, max_duration=12):
     duration = min(max(3, total_chars / 12.0), max_duration)
     total_frames = int(fps * duration)
 
-    frames = []
-    for i in range(total_frames):
-        p = i / max(1, total_frames - 1)
-        typed = int(total_chars * (p ** 1.05))
-        visible = full_text[:typed]
-        fr = base.copy()
-        fd = ImageDraw.Draw(fr)
-        vlines = visible.split('\n') if visible else ['']
-        _, line_h = _text_bbox_size(fd, 'Ay', font)
-        start_y = 140
-        for li, ln in enumerate(vlines):
-            prompt = "$ "
-            fd.text((80, start_y + li*line_h), prompt, font=font, fill=(140,150,165))
-            pw, _ = _text_bbox_size(fd, prompt, font)
-            fd.text((80 + pw, start_y + li*line_h), ln, font=font, fill=TEXT_COLOR)
-        blink_on = (i // max(1, (fps//2))) % 2 == 0
-        if blink_on:
-            last = vlines[-1]
-            cw, ch = _text_bbox_size(fd, last, font)
-            cx = 80 + pw + cw + 4
-            cy = start_y + (len(vlines)-1)*line_h
-            fd.rectangle([cx, cy + int(line_h*0.15), cx+8, cy + int(line_h*0.85)], fill=(200,230,200))
-        frames.append(np.array(fr.convert('RGB'), dtype=np.uint8))
-
-    clip = ImageSequenceClip(frames, fps=fps)
-
-    if AUDIO_FILE and os.path.exists(AUDIO_FILE):
-        try:
-            audio = AudioFileClip(AUDIO_FILE)
-            if audio.duration < clip.duration:
-                n = math.ceil(clip.duration / audio.duration)
-                audio = concatenate_audioclips([audio] * n)
-            audio = audio.subclip(0, clip.duration).volumex(0.45)
-            clip = clip.set_audio(audio)
-            logger.info("Attached audio: %s", AUDIO_FILE)
-        except Exception as e:
-            logger.warning("Failed to attach audio: %s", e)
+    # Draw every line (prompt + text) once; frames only blend the typed part
+    # of each pre-rendered line onto the background array.
+    text_x, start_y = 80, 140
+    _, line_h = _text_bbox_size(draw_tmp, 'Ay', font)
+    pw, _ = _text_bbox_size(draw_tmp, "$ ", font)
+    layers = [_line_layer(ln, font, text_x, start_y + li*line_h, pw) for li, ln in enumerate(lines)]
+    char_px = [[text_x + pw + font.getlength(ln[:k]) for k in range(len(ln) + 1)] for ln in lines]
+    line_starts = []
+    offset = 0
+    for ln in lines:
+        line_starts.append(offset)
+        offset += len(ln) + 1
+    base_arr = np.asarray(base.convert('RGB'), dtype=np.uint8)
+    cursor_y0, cursor_y1 = int(line_h*0.15), int(line_h*0.85) + 1
 
-    tmp_out = out_path_mp4 + ".tmp.mp4"
     out_dir = os.path.dirname(out_path_mp4)
     if out_dir and not os.path.exists(out_dir):
         os.makedirs(out_dir, exist_ok=True)
 
-    clip.write_videofile(tmp_out, codec='libx264', audio_codec='aac', threads=0, verbose=False, logger=None)
-
-    final = ensure_instagram_video_compatible_v2(tmp_out, out_path_mp4, target_width=IMAGE_WIDTH, target_height=IMAGE_HEIGHT, fps=30)
+    # Single encode pass: raw RGB frames go straight to ffmpeg's stdin and come
+    # out already Instagram-compatible, so no follow-up transcode is needed.
+    cmd = [FFMPEG_BIN, '-y', '-hide_banner', '-loglevel', 'error',
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{IMAGE_WIDTH}x{IMAGE_HEIGHT}', '-r', str(fps), '-i', '-']
+    has_audio = bool(AUDIO_FILE and os.path.exists(AUDIO_FILE))
+    if has_audio:
+        # loop the track in ffmpeg itself so short audio still covers the whole clip
+        cmd += ['-stream_loop', '-1', '-i', AUDIO_FILE, '-map', '0:v', '-map', '1:a']
+    cmd += _instagram_video_args(IMAGE_WIDTH, IMAGE_HEIGHT, fps=30)
+    if has_audio:
+        cmd += ['-t', f'{total_frames / fps:.3f}', '-c:a', 'aac', '-b:a', '128k', '-filter:a', 'volume=0.45']
+        logger.info("Attached audio: %s", AUDIO_FILE)
+    cmd += ['-movflags', '+faststart', out_path_mp4]
+
+    logger.info('Running ffmpeg encode: %s', ' '.join(cmd[:6]) + ' ...')
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=1 << 20)
     try:
-        if os.path.exists(tmp_out) and tmp_out != final:
-            os.remove(tmp_out)
-    except Exception:
+        for i in range(total_frames):
+            p = i / max(1, total_frames - 1)
+            typed = int(total_chars * (p ** 1.05))
+            cur = bisect.bisect_right(line_starts, typed) - 1
+            k = min(typed - line_starts[cur], len(lines[cur]))
+            fr = base_arr.copy()
+            for li in range(cur + 1):
+                if layers[li] is None:
+                    continue
+                x0, y0, rgb, alpha = layers[li]
+                cut = rgb.shape[1] if li < cur else max(0, min(rgb.shape[1], int(math.ceil(char_px[li][k])) - x0))
+                if not cut:
+                    continue
+                a = alpha[:, :cut]
+                region = fr[y0:y0 + rgb.shape[0], x0:x0 + cut]
+                region[:] = (rgb[:, :cut] * a + region * (1.0 - a)).astype(np.uint8)
+            blink_on = (i // max(1, (fps//2))) % 2 == 0
+            if blink_on:
+                cx = int(char_px[cur][k]) + 4
+                cy = start_y + cur*line_h
+                fr[cy + cursor_y0:cy + cursor_y1, cx:cx + 9] = (200, 230, 200)
+            proc.stdin.write(fr.tobytes())
+    except BrokenPipeError:
         pass
-    return final
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        logger.warning('ffmpeg encode failed: rc=%s, stderr=%s', proc.returncode, stderr.decode(errors='ignore')[:2000])
+        return render_image(text, out_path_mp4.rsplit('.',1)[0] + '.jpg')
+    ffprobe_inspect(out_path_mp4)
+    IG_COMPATIBLE_PATHS.add(out_path_mp4)
+    return out_path_mp4
 
 # ---- ffprobe inspector ----
 def ffprobe_inspect(path):
@@ -290,6 +365,16 @@ def ffprobe_inspect(path):
         return None
 
 # ---- improved transcoder (v2) ----
+def _instagram_video_args(target_width=1080, target_height=1080, fps=30, crf=23):
+    vf = ("scale='if(gt(a,{w}/{h}),{w},-2)':'if(gt(a,{w}/{h}),-2,{h})',pad=ceil(iw/2)*2:ceil(ih/2)*2").format(w=target_width, h=target_height)
+    if NVENC_AVAILABLE:
+        args = ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll', '-rc', 'vbr', '-cq', str(crf), '-b:v', '0']
+    else:
+        args = ['-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'baseline', '-level', '3.1', '-crf', str(crf)]
+    args += ['-r', str(fps), '-vf', vf, '-pix_fmt', 'yuv420p']
+    return args
+
+
 def ensure_instagram_video_compatible_v2(in_path, out_path=None, target_width=1080, target_height=1080, fps=30, crf=23, audio_bitrate='128k', try_strip_audio=False):
     if out_path is None:
         fd, out_path = tempfile.mkstemp(suffix='.mp4', dir=os.path.dirname(in_path) or '.')
@@ -298,9 +383,11 @@ def ensure_instagram_video_compatible_v2(in_path, out_path=None, target_width=10
         logger.warning('ffmpeg not found, skipping transcode')
         return in_path
 
-    vf = ("scale='if(gt(a,{w}/{h}),{w},-2)':'if(gt(a,{w}/{h}),-2,{h})',pad=ceil(iw/2)*2:ceil(ih/2)*2").format(w=target_width, h=target_height)
-    cmd_base = [FFMPEG_BIN, '-y', '-i', in_path, '-c:v', 'libx264', '-preset', 'veryfast']
-    cmd_base += ['-profile:v', 'baseline', '-level', '3.1', '-crf', str(crf), '-r', str(fps), '-vf', vf, '-pix_fmt', 'yuv420p']
+    cmd_base = [FFMPEG_BIN, '-y']
+    if NVENC_AVAILABLE and in_path.lower().endswith('.mp4'):
+        # decode on the GPU too; frames are downloaded for the CPU scale/pad filters
+        cmd_base += ['-hwaccel', 'cuda']
+    cmd_base += ['-i', in_path] + _instagram_video_args(target_width, target_height, fps, crf)
     if try_strip_audio:
         cmd = cmd_base + ['-an', '-movflags', '+faststart', out_path]
     else:
@@ -310,6 +397,7 @@ def ensure_instagram_video_compatible_v2(in_path, out_path=None, target_width=10
         p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=240)
         logger.debug('ffmpeg stderr: %s', p.stderr.decode(errors='ignore')[:2000])
         ffprobe_inspect(out_path)
+        IG_COMPATIBLE_PATHS.add(out_path)
         return out_path
     except subprocess.CalledProcessError as e:
         logger.warning('ffmpeg first-pass failed: rc=%s, stderr=%s', e.returncode, e.stderr.decode(errors='ignore')[:2000])
@@ -390,13 +478,16 @@ def safe_video_upload(client, path, caption):
 def post_with_retries(client, path, caption, max_attempts=4):
     attempt = 1
     last_exc = None
+    upload_path = None
     while attempt <= max_attempts:
         try:
-            ext = os.path.splitext(path)[1].lower()
-            upload_path = path
-            if ext in ('.mp4', '.mov', '.m4v', '.avi', '.webm'):
-                target = os.path.splitext(path)[0] + '.ig.mp4'
-                upload_path = ensure_instagram_video_compatible_v2(path, target, target_width=IMAGE_WIDTH, target_height=IMAGE_HEIGHT, fps=30)
+            if upload_path is None:
+                ext = os.path.splitext(path)[1].lower()
+                if ext in ('.mp4', '.mov', '.m4v', '.avi', '.webm') and path not in IG_COMPATIBLE_PATHS:
+                    target = os.path.splitext(path)[0] + '.ig.mp4'
+                    upload_path = ensure_instagram_video_compatible_v2(path, target, target_width=IMAGE_WIDTH, target_height=IMAGE_HEIGHT, fps=30)
+                else:
+                    upload_path = path
 
             logger.info('Uploading %s (attempt %s)', upload_path, attempt)
             if upload_path.lower().endswith(('.mp4', '.mov', '.m4v')):
@@ -449,7 +540,9 @@ def main():
         logger.error('Could not login')
         return
 
-    seen = load_seen()
+    # deque keeps the most recent keys in posting order for the cache file; the set gives O(1) lookups
+    seen_order = deque(load_seen(), maxlen=SEEN_MAX)
+    seen = set(seen_order)
 
     while True:
         try:
@@ -471,8 +564,11 @@ def main():
             caption = f"{joke}\n\n#programming #devhumor #coding"
             success = post_with_retries(client, produced, caption)
             if success:
-                seen.append(key)
-                save_seen(seen)
+                if len(seen_order) == seen_order.maxlen:
+                    seen.discard(seen_order[0])
+                seen_order.append(key)
+                seen.add(key)
+                save_seen(seen_order)
         except SystemExit:
             logger.error('Bot stopped due to Instagram block — exit')
             break
@@ -483,5 +579,5 @@ def main():
         time.sleep(POST_INTERVAL)
 
 if __name__ == '__main__':
-    logger.info('POST_VIDEO=%s MOVIEPY=%s FFMPEG=%s FFPROBE=%s SMTP=%s', POST_VIDEO, MOVIEPY_AVAILABLE, bool(os.path.exists(FFMPEG_BIN)), bool(os.path.exists(FFPROBE_BIN)), bool(SMTP_HOST))
+    logger.info('POST_VIDEO=%s FFMPEG=%s NVENC=%s FFPROBE=%s SMTP=%s', POST_VIDEO, bool(os.path.exists(FFMPEG_BIN)), NVENC_AVAILABLE, bool(os.path.exists(FFPROBE_BIN)), bool(SMTP_HOST))
     main()
\ No newline at end of file
@@ -1,9 +1,13 @@
 # auto_meme_agent.py
 import os
 import time
+import json
+import hashlib
 import requests
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from requests.adapters import HTTPAdapter
 from PIL import Image, ImageDraw, ImageFont
 from apscheduler.schedulers.blocking import BlockingScheduler
 from dotenv import load_dotenv
@@ -16,6 +20,8 @@ BACKEND_BASE = os.getenv("BACKEND_BASE", "http://localhost:3000")
 SUBREDDITS = os.getenv("SUBREDDITS", "memes,dankmemes,ProgrammerHumor").split(",")
 FETCH_LIMIT = int(os.getenv("FETCH_LIMIT", "25"))
 MIN_UPVOTES = int(os.getenv("MIN_UPVOTES", "100"))
+SEEN_IMAGES_FILE = os.getenv("SEEN_IMAGES_FILE", "seen_images.json")
+SEEN_IMAGES_MAX = 1000
 
 if OPENAI_API_KEY:
     openai.api_key = OPENAI_API_KEY
@@ -23,9 +29,14 @@ if OPENAI_API_KEY:
 HEADERS = {"User-Agent": "InstaMemeAgent/1.0 (by your-app)"}
 MAX_IMAGE_SIZE = (1080, 1080)
 
+# one pooled session for reddit, image and backend calls so connections are reused
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+
 def fetch_reddit_images(subreddit, limit=20):
     url = f"https://www.reddit.com/r/{subreddit}/hot.json?limit={limit}"
-    res = requests.get(url, headers=HEADERS, timeout=15)
+    res = SESSION.get(url, headers=HEADERS, timeout=15)
     res.raise_for_status()
     items = []
     data = res.json()
@@ -61,6 +72,30 @@ def fetch_reddit_images(subreddit, limit=20):
                     })
     return items
 
+def image_key(url):
+    # crossposts share the image URL under different post ids
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+def load_seen_images():
+    try:
+        if os.path.exists(SEEN_IMAGES_FILE):
+            with open(SEEN_IMAGES_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+                if isinstance(data, list):
+                    return data
+    except Exception as e:
+        print("Failed to load seen images:", e)
+    return []
+
+def save_seen_images(seen):
+    try:
+        tmp = SEEN_IMAGES_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(seen[-SEEN_IMAGES_MAX:], f, indent=2)
+        os.replace(tmp, SEEN_IMAGES_FILE)
+    except Exception as e:
+        print("Failed to save seen images:", e)
+
 def filter_candidates(items):
     seen = set()
     out = []
@@ -72,9 +107,14 @@ def filter_candidates(items):
     return out
 
 def download_image(url):
-    resp = requests.get(url, headers=HEADERS, stream=True, timeout=20)
-    resp.raise_for_status()
-    img = Image.open(BytesIO(resp.content)).convert('RGB')
+    headers = dict(HEADERS, **{"Accept-Encoding": "identity"})
+    with SESSION.get(url, headers=headers, stream=True, timeout=20) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        img = Image.open(resp.raw)
+        # JPEGs can be decoded straight at a reduced scale that still covers MAX_IMAGE_SIZE
+        img.draft('RGB', MAX_IMAGE_SIZE)
+        img = img.convert('RGB')
     return img
 
 def generate_programming_caption(original_title):
@@ -87,13 +127,16 @@ def generate_programming_caption(original_title):
     return resp.choices[0].text.strip()
 
 def overlay_text_on_image(img: Image.Image, caption_text: str):
-    img = img.copy()
+    # shrink first (in place; callers don't reuse img) so the square crop runs on the small image
+    w, h = img.size
+    scale = min(MAX_IMAGE_SIZE) / min(w, h)
+    if scale < 1:
+        img.thumbnail((round(w*scale), round(h*scale)), Image.Resampling.LANCZOS)
     w, h = img.size
     side = min(w,h)
     left = (w-side)//2
     top = (h-side)//2
     img = img.crop((left, top, left+side, top+side))
-    img.thumbnail(MAX_IMAGE_SIZE)
     draw = ImageDraw.Draw(img)
     try:
         font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", size=36)
@@ -102,17 +145,22 @@ def overlay_text_on_image(img: Image.Image, caption_text: str):
     margin = 12
     max_width = img.width - margin*2
     words = caption_text.split()
+    widths = [font.getlength(w) for w in words]
+    space_w = font.getlength(" ")
     lines = []
     cur = ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if draw.textsize(test, font=font)[0] <= max_width:
-            cur = test
+    cur_w = 0
+    for w, w_px in zip(words, widths):
+        if not cur:
+            cur, cur_w = w, w_px
+        elif cur_w + space_w + w_px <= max_width:
+            cur += " " + w
+            cur_w += space_w + w_px
         else:
             lines.append(cur)
-            cur = w
+            cur, cur_w = w, w_px
     if cur: lines.append(cur)
-    line_h = draw.textsize("A", font=font)[1]
+    line_h = font.getbbox("A")[3]
     total_h = line_h*len(lines) + margin*2
     rect_y0 = img.height - total_h - 10
     overlay_box = Image.new("RGBA", (img.width, total_h), (0,0,0,160))
@@ -125,17 +173,17 @@ def overlay_text_on_image(img: Image.Image, caption_text: str):
 
 def upload_to_backend(img: Image.Image):
     buf = BytesIO()
-    img.save(buf, format='JPEG', quality=85)
+    img.save(buf, format='JPEG', quality=85, optimize=True, progressive=True, subsampling=2)
     buf.seek(0)
     files = {'file': ('meme.jpg', buf, 'image/jpeg')}
-    r = requests.post(f"{BACKEND_BASE}/api/upload", files=files, timeout=60)
+    r = SESSION.post(f"{BACKEND_BASE}/api/upload", files=files, timeout=60)
     r.raise_for_status()
     return r.json().get('imageUrl')
 
 def schedule_post(image_url, caption):
     schedule_time = time.time() + 3600
     schedule_iso = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(schedule_time))
-    resp = requests.post(f"{BACKEND_BASE}/api/schedule", json={'imageUrl': image_url, 'caption': caption, 'scheduleTime': schedule_iso}, timeout=30)
+    resp = SESSION.post(f"{BACKEND_BASE}/api/schedule", json={'imageUrl': image_url, 'caption': caption, 'scheduleTime': schedule_iso}, timeout=30)
     resp.raise_for_status()
     return resp.json()
 
@@ -152,25 +200,38 @@ def process_one(candidate):
         print("Error:", e)
         return False
 
+def fetch_subreddit(sr):
+    try:
+        return fetch_reddit_images(sr, limit=FETCH_LIMIT)
+    except Exception as e:
+        print("Fetch error", sr, e)
+        return []
+
 def run_once():
     all_cands = []
-    for sr in SUBREDDITS:
-        try:
-            items = fetch_reddit_images(sr, limit=FETCH_LIMIT)
+    with ThreadPoolExecutor(max_workers=max(1, len(SUBREDDITS))) as ex:
+        for items in ex.map(fetch_subreddit, SUBREDDITS):
             all_cands.extend(items)
-        except Exception as e:
-            print("Fetch error", sr, e)
-    unique = {c['id']: c for c in all_cands}.values()
-    filtered = filter_candidates(unique)
+    seen_images = load_seen_images()
+    seen_set = set(seen_images)
+    unique = {image_key(c['image_url']): c for c in all_cands}
+    filtered = filter_candidates(c for k, c in unique.items() if k not in seen_set)
     processed = 0
-    for c in filtered:
-        if processed >= 3: break
-        if process_one(c):
-            processed += 1
+    # candidates are independent, so work on as many at once as posts are still needed
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        while processed < 3 and filtered:
+            batch, filtered = filtered[:3 - processed], filtered[3 - processed:]
+            for c, ok in zip(batch, ex.map(process_one, batch)):
+                if ok:
+                    processed += 1
+                    seen_images.append(image_key(c['image_url']))
+    if processed:
+        save_seen_images(seen_images)
 
 if __name__ == '__main__':
-    sched = BlockingScheduler()
-    sched.add_job(run_once, 'interval', minutes=60)
+    sched = BlockingScheduler(executors={'default': {'type': 'threadpool', 'max_workers': 4}})
+    # an overrunning run_once must not stack up queued runs behind it
+    sched.add_job(run_once, 'interval', minutes=60, coalesce=True, max_instances=1, misfire_grace_time=300)
     print("Auto-meme agent started.")
     try:
         sched.start()